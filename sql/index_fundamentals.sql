@@ -0,0 +1,29 @@
+-- Fundamentals for every constituent of an index on a given date.
+-- Joins constituents_history, stocks and fundamentals_daily server-side so
+-- the dashboard needs a single round trip per page load.
+--
+-- usage: supabase.rpc("index_fundamentals", {"p_index": "S&P 500", "p_dt": "2025-09-30"})
+
+create or replace function index_fundamentals(p_index text, p_dt date)
+returns setof fundamentals_daily
+language sql
+stable
+as $$
+    select f.*
+    from fundamentals_daily f
+    where f.dt = p_dt
+      and exists (
+          select 1
+          from constituents_history c
+          join stocks s on s.ticker = c.ticker
+          where c.ticker = f.ticker
+            and c."index" = p_index
+            and c.included_start <= p_dt
+            and c.included_end >= p_dt
+      );
+$$;
+
+-- the membership check above is correlated on ticker, so seek on
+-- (index, ticker) first and range-check the inclusion dates from the index
+create index if not exists constituents_history_index_ticker_included_idx
+    on constituents_history ("index", ticker, included_start, included_end);
@@ -0,0 +1,20 @@
+-- Dates with fundamentals available, one row per dt.
+
+create materialized view if not exists mv_fundamentals_dates as
+    select dt, count(*) as c
+    from fundamentals_daily
+    group by dt;
+
+-- required by refresh ... concurrently
+create unique index if not exists mv_fundamentals_dates_dt_idx
+    on mv_fundamentals_dates (dt);
+
+-- refresh nightly, after the fundamentals_daily load
+-- (scheduling the same job name again updates the existing job)
+create extension if not exists pg_cron;
+
+select cron.schedule(
+    'refresh-mv-fundamentals-dates',
+    '0 3 * * *',
+    'refresh materialized view concurrently mv_fundamentals_dates'
+);
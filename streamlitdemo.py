@@ -1,74 +1,140 @@
+import os
+import re
+import tempfile
+import time
+from pathlib import Path
+from typing import Final
+
 import streamlit as st
 import pandas as pd
 import numpy as np
-from datetime import datetime, timedelta
 from supabase import create_client
 
 INDEX_OPTIONS = {"S&P 500"}
 
+# display formatting; lists rather than tuples because pandas reads a tuple
+# as a single (MultiIndex) column key
+RENAME_MAP: Final = {
+    "perf_1m": "1M Perf (%)",
+    "perf_3m": "3M Perf (%)",
+    "perf_6m": "6M Perf (%)",
+    "perf_1y": "1Y Perf (%)",
+    "perf_3y": "3Y Perf (%)",
+    "perf_5y": "5Y Perf (%)",
+    "revenue_1y": "Revenue 1Y (X)",
+    "revenue_5y": "Revenue 5Y (X)",
+    "earning_1y": "Earnings 1Y (X)",
+    "earning_5y": "Earnings 5Y (X)",
+    "net_margin": "Net Margin",
+    "cash_to_dept": "Cash/Dept",
+    "growth_1y": "Growth 1Y",
+    "price": "Price",
+}
+X_NOTATION_COLS: Final = ["Revenue 1Y (X)", "Revenue 5Y (X)", "Earnings 1Y (X)", "Earnings 5Y (X)"]
+PERCENTAGE_COLS: Final = ["1M Perf (%)","3M Perf (%)","6M Perf (%)","1Y Perf (%)","3Y Perf (%)","5Y Perf (%)"]
+DROP_COLS: Final = ["fpe", "ibd_score", "dt", "rev_earnings"]
+
+# on-disk cache below st.cache_data; survives restarts and is shared by workers.
+# Set FUNDALYTIX_CACHE_DIR where the app directory is read-only.
+CACHE_DIR = Path(os.environ.get("FUNDALYTIX_CACHE_DIR", Path(__file__).parent / "cache"))
+CACHE_TTL_SECONDS: Final = 3600  # late loads and corrections show up within an hour
+
 # ----------------------
 # read secrets
 url = st.secrets["SUPABASE_URL"]
 key = st.secrets["SUPABASE_KEY"]
 
-# create supabase client
-supabase = create_client(url, key)
+# create supabase client once per process; its HTTP connection pool is
+# reused across reruns and sessions
+@st.cache_resource
+def get_supabase():
+    return create_client(url, key)
 
 # ----------------------
 # Helpers to fetch data
 # ----------------------
 @st.cache_data(ttl=300)  # cache for 5 minutes
-def load_stocks(index_list):
-    resp = supabase.table("stocks").select("*").execute()
-    df = pd.DataFrame(resp.data)
-    df = df[df["ticker"].isin(index_list)]
-    return df
-
-@st.cache_data(ttl=300)  # cache for 5 minutes
-def get_index_list(ref_date: str, index_name):
-    # supabase expects ISO date strings for filtering
+def load_fundamentals_for_date(ref_date, index_name) -> pd.DataFrame:
+    slug = re.sub(r"[^0-9A-Za-z]+", "_", index_name).strip("_")
+    cache_path = CACHE_DIR / f"index_fundamentals_{slug}_{ref_date}.parquet"
+    try:
+        if time.time() - cache_path.stat().st_mtime < CACHE_TTL_SECONDS:
+            return pd.read_parquet(cache_path)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError):
+        # unreadable file: treat as a miss, it is rewritten below
+        cache_path.unlink(missing_ok=True)
+
+    # constituents/stocks/fundamentals are joined server-side (see sql/index_fundamentals.sql)
     resp = (
-        supabase
-        .table("constituents_history")
-        .select("*")
-        .eq("index", index_name)
+        get_supabase()
+        .rpc("index_fundamentals", {"p_index": index_name, "p_dt": ref_date})
         .execute()
     )
     df = pd.DataFrame(resp.data)
-    df = df[df["included_start"] <= ref_date]
-    df = df[df["included_end"] >= ref_date]
-    df = df.drop_duplicates(subset=["ticker"])
-    return df["ticker"].to_list()
 
-@st.cache_data(ttl=300)  # cache for 5 minutes
-def load_fundamentals_for_date(ref_date, index_name) -> pd.DataFrame:
-    index_list = get_index_list(ref_date, index_name)
-    stocks = load_stocks(index_list)["ticker"].tolist()
-    
-    # supabase expects ISO date strings for filtering
-    resp = (
-        supabase
-        .table("fundamentals_daily")
-        .select("*")
-        .eq("dt", ref_date)
-        .in_("ticker", stocks)
-        .execute()
-    )
-    return pd.DataFrame(resp.data)
+    # don't pin an empty result, the date may not be loaded yet
+    if not df.empty:
+        tmp_path = None
+        try:
+            CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            # temp files left by a process killed mid-write
+            for stale in CACHE_DIR.glob("*.parquet.tmp"):
+                if time.time() - stale.stat().st_mtime > CACHE_TTL_SECONDS:
+                    stale.unlink(missing_ok=True)
+            # write then rename, so other workers never read a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".parquet.tmp")
+            os.close(fd)
+            df.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, cache_path)
+        except (OSError, ValueError, TypeError):
+            # the disk cache is best-effort; still serve what was fetched
+            pass
+        finally:
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+    return df
 
+@st.cache_data(ttl=3600)  # dates change at most daily
 def load_fundamentals_available_dates():
+    # aggregated server-side (see sql/mv_fundamentals_dates.sql)
+    # not used by the UI yet: the date selectbox still lists fixed quarter-ends
     resp = (
-        supabase
-        .table("fundamentals_daily")
-        .select("dt", count="exact")
-        .group("dt")
+        get_supabase()
+        .table("mv_fundamentals_dates")
+        .select("dt")
         .order("dt", desc=True)
         .execute()
     )
     df = pd.DataFrame(resp.data)
-    df["dt"] = pd.to_datetime(df["dt"]).dt.date
+    df["dt"] = pd.to_datetime(df["dt"], format="%Y-%m-%d", cache=True).dt.date
     return df
 
+# ----------------------
+# Display formatting
+# ----------------------
+@st.cache_data(ttl=300)  # cache for 5 minutes
+def load_display_fundamentals(ref_date, index_name) -> pd.DataFrame:
+    # st.cache_data hands back a fresh copy, so it is safe to format in place
+    df_display = load_fundamentals_for_date(ref_date, index_name)
+    if df_display.empty:  # date not loaded yet
+        return df_display
+
+    # --- Formatting Columns ---
+    df_display.rename(columns=RENAME_MAP, inplace=True)
+
+    # Convert performance columns to X-notation
+    df_display[PERCENTAGE_COLS] = (df_display[PERCENTAGE_COLS] * 100).round(2)  # e.g., 0.1234 → 12.34%
+    df_display[X_NOTATION_COLS] = (df_display[X_NOTATION_COLS] * 100).round(2) / 100  # e.g., 1.25 → 1.25x
+
+    # Hide unwanted columns
+    df_display.drop(columns=DROP_COLS, inplace=True, errors='ignore')
+
+    # Arrow-backed strings, so st.dataframe can serialize the column without conversion
+    df_display["ticker"] = df_display["ticker"].astype("string[pyarrow]")
+    return df_display
+
 
 # -------------------------------------------------------
 # 🖥️ Streamlit UI
@@ -91,40 +157,10 @@ st.write(f"Using reference date: {ref_date}")
 # --- Fetch Data Button ---
 if st.button("Load Fundamentals"):
     with st.spinner("Fetching data... this may take a minute"):
-        df = load_fundamentals_for_date(ref_date, index_choice)
-
-        # --- Formatting Columns ---
-        df_display = df.copy()
-
-        # Rename columns
-        df_display.rename(columns={
-            "perf_1m": "1M Perf (%)",
-            "perf_3m": "3M Perf (%)",
-            "perf_6m": "6M Perf (%)",
-            "perf_1y": "1Y Perf (%)",
-            "perf_3y": "3Y Perf (%)",
-            "perf_5y": "5Y Perf (%)",
-            "revenue_1y": "Revenue 1Y (X)",
-            "revenue_5y": "Revenue 5Y (X)",
-            "earning_1y": "Earnings 1Y (X)",
-            "earning_5y": "Earnings 5Y (X)",
-            "net_margin": "Net Margin",
-            "cash_to_dept": "Cash/Dept",
-            "growth_1y": "Growth 1Y",
-            "price": "Price",
-        }, inplace=True)
-
-        # Convert performance columns to X-notation
-        x_notation_cols = ["Revenue 1Y (X)", "Revenue 5Y (X)", "Earnings 1Y (X)", "Earnings 5Y (X)"]
-        percentage_cols = ["1M Perf (%)","3M Perf (%)","6M Perf (%)","1Y Perf (%)","3Y Perf (%)","5Y Perf (%)"]
-
-        for col in percentage_cols:
-            df_display[col] = (df_display[col] * 100).round(2)  # e.g., 0.1234 → 12.34%
-        for col in x_notation_cols:
-            df_display[col] = (df_display[col] * 100).round(2) / 100  # e.g., 1.25 → 1.25x
-
-        # Hide unwanted columns
-        df_display.drop(columns=["fpe", "ibd_score", "dt", "rev_earnings"], inplace=True, errors='ignore')
+        df_display = load_display_fundamentals(ref_date, index_choice)
+        if df_display.empty:
+            st.info(f"No fundamentals loaded for {index_choice} on {ref_date} yet.")
+            st.stop()
 
         # --- Display Individual Stocks ---
         st.subheader("Individual Stock Fundamentals")
@@ -141,7 +177,7 @@ if st.button("Load Fundamentals"):
         # numeric_cols = df_avg_display.select_dtypes(include=np.number).columns
 
         # # Format only numeric columns in X-notation
-        # styled_df = df_avg_display.style.format({col: "{:.2f}x" for col in x_notation_cols})
+        # styled_df = df_avg_display.style.format({col: "{:.2f}x" for col in X_NOTATION_COLS})
 
         # # Function to color cells relative to column mean
         # means = df_display.mean(numeric_only=True)